@@ -1,17 +1,231 @@
 import os
 import sys
 import argparse
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
 import json
+import queue
+import re
+import threading
+import tempfile
 import traceback
+import httpx
 import pyodbc
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
 
-# Try modern OpenAI SDK first; fallback to legacy if needed
+# turbodbc is optional; it bulk-reads result sets into Arrow buffers in C
 try:
-    from openai import OpenAI
-    _OPENAI_SDK = "v1"
-except Exception:
-    import openai as OpenAI  # type: ignore
-    _OPENAI_SDK = "legacy"
+    import turbodbc
+except ImportError:
+    turbodbc = None
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+# openai>=1.40 is required: AsyncOpenAI, the Batch API, and structured
+# outputs do not exist in the 0.x SDK
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+# Completion budget per request; also used to estimate token spend up front.
+# Structured outputs keep replies terse, so 200 is plenty for one verdict.
+MAX_COMPLETION_TOKENS = 200
+
+# Invariant prompt text lives at module scope and is sent byte-identical on
+# every request, so OpenAI's automatic prompt caching can reuse the prefix
+# (cached input tokens are billed at ~50% with lower TTFT)
+SYSTEM_MSG = (
+    "You are a senior security analyst and software developer. "
+    "Evaluate the provided alert and code snippet. "
+    "Decide whether it is a false_positive, true_positive, or secure. "
+    "Use the dismissed_reason and dismissed_comment as context. "
+    "If evidence is insufficient, use 'uncertain' with confidence 'low'. "
+    "Keep the reasoning and recommended_action concise."
+)
+
+PACKED_SYSTEM_MSG = (
+    "You are a senior security analyst and software developer. "
+    "You receive a JSON array of alerts, each with an alert_id, rule_id, "
+    "dismissed_reason, dismissed_comment, and code_snippet. "
+    "For every alert decide whether it is a false_positive, true_positive, or secure. "
+    "Use the dismissed_reason and dismissed_comment as context. "
+    "If evidence is insufficient, use 'uncertain' with confidence 'low'. "
+    "Return one result object per alert, keyed by its alert_id."
+)
+
+# JSON schema enforced via response_format, so replies parse unconditionally
+_CLASSIFICATION_PROPERTIES = {
+    "classification": {
+        "type": "string",
+        "enum": ["false_positive", "true_positive", "secure", "uncertain"],
+    },
+    "confidence": {"type": "string", "enum": ["high", "low"]},
+    "reasoning": {"type": "string"},
+    "recommended_action": {"type": "string"},
+}
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "alert_classification",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": _CLASSIFICATION_PROPERTIES,
+            "required": list(_CLASSIFICATION_PROPERTIES),
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Strict schemas require an object root, so packed results ride in "results"
+PACKED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "alert_classifications",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "alert_id": {"type": "string"},
+                            **_CLASSIFICATION_PROPERTIES,
+                        },
+                        "required": ["alert_id"] + list(_CLASSIFICATION_PROPERTIES),
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+USER_MSG_HEADER = (
+    "Analyze this alert and code snippet.\n"
+    "Fields follow in a fixed order: alert_id, rule_id, dismissed_reason, "
+    "dismissed_comment, code_snippet.\n"
+)
+
+# Durable output: analysis verdicts land here instead of only on stdout
+CREATE_ANALYSIS_TABLE = """
+    IF OBJECT_ID('alert_analysis', 'U') IS NULL
+    CREATE TABLE alert_analysis (
+        alert_id NVARCHAR(255) PRIMARY KEY,
+        classification NVARCHAR(32),
+        reasoning NVARCHAR(MAX),
+        recommended_action NVARCHAR(MAX)
+    )
+"""
+
+# Fan one representative verdict out to every alert sharing the snippet hash
+INSERT_ANALYSIS_FANOUT = """
+    INSERT INTO alert_analysis (alert_id, classification, reasoning, recommended_action)
+    SELECT a.alert_id, ?, ?, ?
+    FROM alerts a
+    WHERE HASHBYTES('SHA2_256', a.code_snippet) = ?
+      AND (a.rule_id IS NULL OR LOWER(a.rule_id) NOT LIKE '%(sca)%')
+      AND NOT EXISTS (
+          SELECT 1 FROM alert_analysis x WHERE x.alert_id = a.alert_id
+      )
+"""
+
+# NULL snippets all hash to NULL, which '=' can never match, so that group
+# gets its own fanout keyed on code_snippet IS NULL
+INSERT_ANALYSIS_NULL_FANOUT = """
+    INSERT INTO alert_analysis (alert_id, classification, reasoning, recommended_action)
+    SELECT a.alert_id, ?, ?, ?
+    FROM alerts a
+    WHERE a.code_snippet IS NULL
+      AND (a.rule_id IS NULL OR LOWER(a.rule_id) NOT LIKE '%(sca)%')
+      AND NOT EXISTS (
+          SELECT 1 FROM alert_analysis x WHERE x.alert_id = a.alert_id
+      )
+"""
+
+# Startup catch-up: alerts inserted after their snippet's representative was
+# analyzed would otherwise be skipped by the checkpoint and never fanned out;
+# give them the existing verdict before the run begins
+FANOUT_EXISTING_ANALYSIS = """
+    INSERT INTO alert_analysis (alert_id, classification, reasoning, recommended_action)
+    SELECT a.alert_id, v.classification, v.reasoning, v.recommended_action
+    FROM alerts a
+    CROSS APPLY (
+        SELECT TOP 1 x.classification, x.reasoning, x.recommended_action
+        FROM alerts r
+        JOIN alert_analysis x ON x.alert_id = r.alert_id
+        WHERE (a.code_snippet IS NULL AND r.code_snippet IS NULL)
+           OR HASHBYTES('SHA2_256', a.code_snippet) = HASHBYTES('SHA2_256', r.code_snippet)
+    ) v
+    WHERE (a.rule_id IS NULL OR LOWER(a.rule_id) NOT LIKE '%(sca)%')
+      AND NOT EXISTS (
+          SELECT 1 FROM alert_analysis y WHERE y.alert_id = a.alert_id
+      )
+"""
+
+# Flush writeback buffers to SQL every this many completed rows
+WRITEBACK_CHUNK = 500
+
+# Running prompt-token totals, used to confirm prompt-cache hits at the end
+_usage_totals = {"prompt_tokens": 0, "cached_tokens": 0}
+
+
+def _track_usage(resp):
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return
+    _usage_totals["prompt_tokens"] += usage.prompt_tokens or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None:
+        _usage_totals["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+# Transient API failures worth retrying; anything else falls through
+# to the "uncertain" stub in analyze_with_gpt
+_RETRYABLE_ERRORS = (
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(_RETRYABLE_ERRORS),
+    reraise=True,
+)
+async def _chat_completion(client, model, messages, request_limiter, token_limiter, est_tokens,
+                           max_tokens=MAX_COMPLETION_TOKENS, response_format=RESPONSE_FORMAT):
+    # Rate limiters live inside the retry so each attempt pays its budget
+    async with request_limiter:
+        await token_limiter.acquire(min(est_tokens, token_limiter.max_rate))
+        resp = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0.2,
+            max_tokens=max_tokens,
+            response_format=response_format,
+        )
+        _track_usage(resp)
+        return resp
 
 
 def build_conn_str(
@@ -29,33 +243,104 @@ def build_conn_str(
     )
 
 
+class ConnectionPool:
+    """
+    Small thread-safe pool of pre-opened pyodbc connections. An ODBC
+    handshake typically costs 100ms+, so retries and parallel result
+    writeback borrow a live connection instead of reconnecting.
+    """
+
+    def __init__(self, conn_str: str, timeout: int = 30, min_size: int = 2, max_size: int = 8):
+        self._conn_str = conn_str
+        self._timeout = timeout
+        self._max_size = max_size
+        self._size = 0
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        for _ in range(min_size):
+            self._idle.put(self._connect())
+
+    def _connect(self):
+        with self._lock:
+            self._size += 1
+        return pyodbc.connect(self._conn_str, timeout=self._timeout)
+
+    def acquire_blocking(self):
+        # Prefer an idle connection; grow up to max_size, then wait
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_grow = self._size < self._max_size
+            if can_grow:
+                return self._connect()
+            return self._idle.get()
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        # pyodbc is sync, so the potentially blocking acquire runs in a thread
+        conn = await asyncio.to_thread(self.acquire_blocking)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def build_http_client(max_connections: int = 512, timeout: float = 60.0):
+    # The SDK's default httpx transport degrades past ~100 concurrent
+    # requests; raise the pool limits and multiplex over HTTP/2 so the
+    # client is not the bottleneck below the API rate limit
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        ),
+        http2=True,
+        timeout=httpx.Timeout(timeout),
+    )
+
+
+def load_api_key(path_or_key: str) -> str:
+    """Accept either a path to a key file or the raw key itself."""
+    if os.path.isfile(path_or_key):
+        with open(path_or_key, "r") as f:
+            return f.read().strip()
+    return path_or_key.strip()
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_http_client():
+    return build_http_client()
+
+
+@functools.lru_cache(maxsize=1)
 def get_openai_client(api_key: str):
-    if _OPENAI_SDK == "v1":
-        return OpenAI(api_key=api_key)
-    else:
-        OpenAI.api_key = api_key  # legacy
-        return OpenAI
+    # Cached so the whole fan-out shares one client and one pooled HTTP/2
+    # transport instead of constructing per call
+    return AsyncOpenAI(api_key=load_api_key(api_key), http_client=_shared_http_client())
 
 
-def analyze_with_gpt(client, model: str, payload: dict):
-    """
-    Ask GPT-4o to classify the alert based on code_snippet, dismissed_reason,
-    and dismissed_comment. Returns a dict with classification, reasoning, and recommended_action.
+def build_messages(payload: dict):
+    """Build the (system, user) message pair for one alert payload.
+
+    The constant header comes first so the cacheable prefix extends past the
+    system message; per-row values are interpolated only at the tail.
     """
-    system_msg = (
-        "You are a senior security analyst and software developer. "
-        "Evaluate the provided alert and code snippet. "
-        "Decide whether it is a false_positive, true_positive, or secure. "
-        "Use the dismissed_reason and dismissed_comment as context. "
-        "If evidence is insufficient, use 'uncertain'. "
-        "Respond with ONLY a compact JSON object: "
-        '{"classification":"false_positive|true_positive|secure|uncertain",'
-        '"reasoning":"...",'
-        '"recommended_action":"..."}'
-    )
-
-    user_msg = (
-        "Analyze this alert and code snippet.\n"
+    user_msg = USER_MSG_HEADER + (
         f"alert_id: {payload.get('alert_id')}\n"
         f"rule_id: {payload.get('rule_id')}\n"
         f"dismissed_reason: {payload.get('dismissed_reason')}\n"
@@ -63,44 +348,97 @@ def analyze_with_gpt(client, model: str, payload: dict):
         "code_snippet:\n"
         f"{payload.get('code_snippet')}\n"
     )
+    return SYSTEM_MSG, user_msg
+
+
+# Snippet preprocessing: comments and blank runs add tokens without adding
+# signal for classification
+_BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+_LINE_COMMENT_RE = re.compile(r"//[^\n]*")
+_BLANK_RUN_RE = re.compile(r"\n{3,}")
+
+
+def trim_snippet(snippet, max_chars: int = 4000, line_number=None, context_lines: int = 40):
+    """
+    Shrink a code snippet before it is sent to the model: strip comments,
+    collapse runs of blank lines, optionally slice a window around the
+    flagged line, and enforce a hard character cap. Prompt tokens (and so
+    cost and latency) drop linearly with the removed text.
+    """
+    if not snippet:
+        return snippet
+    text = _BLOCK_COMMENT_RE.sub("", str(snippet))
+    text = _LINE_COMMENT_RE.sub("", text)
+    text = _BLANK_RUN_RE.sub("\n\n", text)
+    if line_number:
+        lines = text.splitlines()
+        start = max(int(line_number) - 1 - context_lines, 0)
+        text = "\n".join(lines[start : int(line_number) + context_lines])
+    if len(text) > max_chars:
+        text = text[:max_chars] + "\n... [snippet truncated]"
+    return text
+
+
+# Payload fields the model should actually see; bookkeeping fields like
+# snippet_hash stay out of the prompt
+PROMPT_FIELDS = ("alert_id", "rule_id", "dismissed_reason", "dismissed_comment", "code_snippet")
+
+
+def build_packed_messages(chunk: list):
+    """
+    Build one (system, user) message pair covering several alert payloads,
+    amortizing the fixed system prompt across the whole chunk.
+    """
+    prompt_rows = [{field: payload.get(field) for field in PROMPT_FIELDS} for payload in chunk]
+    return PACKED_SYSTEM_MSG, json.dumps(prompt_rows, default=str)
+
+
+def needs_escalation(result) -> bool:
+    """True when a cheap-model verdict is too weak to trust as final."""
+    if not isinstance(result, dict):
+        return True
+    if result.get("classification", "uncertain") == "uncertain":
+        return True
+    return str(result.get("confidence", "")).lower() == "low"
+
+
+def cache_key(model: str, system_msg: str, user_msg: str) -> str:
+    """Stable key for a (model, prompt) pair, for result deduplication."""
+    return hashlib.sha256((model + system_msg + user_msg).encode("utf-8")).hexdigest()
+
+
+async def analyze_with_gpt(client, model: str, payload: dict, sem, request_limiter, token_limiter,
+                           cache=None):
+    """
+    Ask GPT-4o to classify the alert based on code_snippet, dismissed_reason,
+    and dismissed_comment. Returns a dict with classification, reasoning, and recommended_action.
+    Concurrency is bounded by `sem`; `request_limiter`/`token_limiter` keep us
+    under the account's requests-per-minute and tokens-per-minute ceilings.
+    Duplicate prompts are served from `cache` without an API call.
+    """
+    system_msg, user_msg = build_messages(payload)
+
+    key = cache_key(model, system_msg, user_msg)
+    if cache is not None and key in cache:
+        return cache[key]
 
     try:
-        if _OPENAI_SDK == "v1":
-            resp = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_msg},
-                ],
-                temperature=0.2,
-                max_tokens=500,
+        # Rough token estimate (~4 chars/token) plus the completion budget
+        est_tokens = len(system_msg + user_msg) // 4 + MAX_COMPLETION_TOKENS
+        messages = [
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg},
+        ]
+        async with sem:
+            resp = await _chat_completion(
+                client, model, messages, request_limiter, token_limiter, est_tokens
             )
-            content = resp.choices[0].message.content
-        else:
-            resp = client.ChatCompletion.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user", "content": user_msg},
-                ],
-                temperature=0.2,
-                max_tokens=500,
-            )
-            content = resp.choices[0].message["content"]
-
-        # Parse JSON strictly; try to recover if wrapped
-        try:
-            return json.loads(content)
-        except json.JSONDecodeError:
-            start = content.find("{")
-            end = content.rfind("}")
-            if start != -1 and end != -1 and end > start:
-                return json.loads(content[start : end + 1])
-            return {
-                "classification": "uncertain",
-                "reasoning": "Model returned non-JSON content.",
-                "recommended_action": "Review manually.",
-            }
+        # Schema-constrained output parses unconditionally; a refusal or
+        # decode failure drops into the stub branch below
+        result = json.loads(resp.choices[0].message.content)
+        if cache is not None:
+            cache[key] = result
+        return result
     except Exception as api_err:
         return {
             "classification": "uncertain",
@@ -109,6 +447,127 @@ def analyze_with_gpt(client, model: str, payload: dict):
         }
 
 
+async def analyze_chunk_with_gpt(client, model: str, chunk: list, sem, request_limiter, token_limiter,
+                                 cache=None) -> dict:
+    """
+    Classify a chunk of alerts with a single packed call. Returns
+    {alert_id: result_dict}; alerts the model dropped from its array
+    are retried individually so nothing is silently lost.
+    """
+    system_msg, user_msg = build_packed_messages(chunk)
+    results = {}
+
+    key = cache_key(model, system_msg, user_msg)
+    if cache is not None and key in cache:
+        results.update(cache[key])
+    else:
+        try:
+            est_tokens = len(system_msg + user_msg) // 4 + MAX_COMPLETION_TOKENS * len(chunk)
+            messages = [
+                {"role": "system", "content": system_msg},
+                {"role": "user", "content": user_msg},
+            ]
+            async with sem:
+                resp = await _chat_completion(
+                    client, model, messages, request_limiter, token_limiter, est_tokens,
+                    max_tokens=MAX_COMPLETION_TOKENS * len(chunk),
+                    response_format=PACKED_RESPONSE_FORMAT,
+                )
+            parsed = json.loads(resp.choices[0].message.content)
+            for entry in parsed.get("results", []):
+                if isinstance(entry, dict) and "alert_id" in entry:
+                    results[str(entry["alert_id"])] = entry
+            if cache is not None and results:
+                cache[key] = dict(results)
+        except Exception as api_err:
+            print(f"Packed call failed, falling back to per-row: {api_err}", file=sys.stderr)
+
+    # Fall back to per-row calls for any alert_id missing from the array
+    for payload in chunk:
+        alert_key = str(payload["alert_id"])
+        if alert_key not in results:
+            results[alert_key] = await analyze_with_gpt(
+                client, model, payload, sem, request_limiter, token_limiter, cache=cache
+            )
+    return results
+
+
+async def run_batch(client, model: str, payloads: list) -> dict:
+    """
+    Submit every payload as one OpenAI Batch job (50% cheaper than realtime)
+    and block until it finishes. Returns {custom_id: result_dict} for a
+    completed batch, with per-request error lines stubbed; a batch that ends
+    failed/expired/cancelled raises so nothing is persisted as analyzed.
+    """
+    # Write one /v1/chat/completions request per line, keyed by alert_id
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".jsonl", delete=False, encoding="utf-8"
+    ) as f:
+        input_path = f.name
+        for payload in payloads:
+            system_msg, user_msg = build_messages(payload)
+            f.write(json.dumps({
+                "custom_id": str(payload["alert_id"]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": [
+                        {"role": "system", "content": system_msg},
+                        {"role": "user", "content": user_msg},
+                    ],
+                    "temperature": 0.2,
+                    "max_tokens": MAX_COMPLETION_TOKENS,
+                    "response_format": RESPONSE_FORMAT,
+                },
+            }) + "\n")
+
+    try:
+        with open(input_path, "rb") as f:
+            batch_file = await client.files.create(file=f, purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        print(f"Batch {batch.id} submitted with {len(payloads)} requests.")
+
+        # Poll with exponential backoff; the SLA is <24h but most jobs
+        # complete far sooner
+        delay = 10
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+            batch = await client.batches.retrieve(batch.id)
+            print(f"Batch {batch.id} status: {batch.status}")
+
+        if batch.status != "completed":
+            # Abort rather than return an empty mapping: persisting stub
+            # verdicts for a failed batch would checkpoint every alert as
+            # analyzed and a rerun would skip them all forever
+            raise RuntimeError(f"Batch {batch.id} ended in status '{batch.status}'.")
+
+        output = await client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            if response.get("status_code") == 200:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[entry["custom_id"]] = json.loads(content)
+            else:
+                results[entry["custom_id"]] = {
+                    "classification": "uncertain",
+                    "reasoning": f"Batch request failed: {entry.get('error')}",
+                    "recommended_action": "Retry or check API configuration.",
+                }
+        return results
+    finally:
+        os.unlink(input_path)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Query SQL Server alerts, analyze code snippets with GPT-4o per row."
@@ -130,8 +589,50 @@ def main():
         help='ODBC driver (default: "ODBC Driver 17 for SQL Server").'
     )
     parser.add_argument(
-        "--model", default="gpt-4o",
-        help="OpenAI model to use (default: gpt-4o)."
+        "--driver-backend", choices=("pyodbc", "turbodbc"), default="pyodbc",
+        help="ODBC backend; turbodbc bulk-reads into Arrow buffers for much "
+             "faster fetches on large tables (default: pyodbc)."
+    )
+    parser.add_argument(
+        "--cheap-model", default="gpt-4o-mini",
+        help="Model tried first for every alert (default: gpt-4o-mini)."
+    )
+    parser.add_argument(
+        "--strong-model", default="gpt-4o",
+        help="Model used to re-run alerts the cheap model marked uncertain "
+             "or low-confidence (default: gpt-4o)."
+    )
+    parser.add_argument(
+        "--mode", choices=("realtime", "batch"), default="realtime",
+        help="realtime: concurrent chat completions; batch: one Batch API job "
+             "(50%% cheaper, <24h completion window)."
+    )
+    parser.add_argument(
+        "--max-concurrency", type=int, default=16,
+        help="Maximum in-flight OpenAI requests (default: 16)."
+    )
+    parser.add_argument(
+        "--pack-size", type=int, default=1,
+        help="Alerts packed into one prompt; >1 amortizes the system message "
+             "across K rows (default: 1)."
+    )
+    parser.add_argument(
+        "--snippet-max-chars", type=int, default=4000,
+        help="Character cap applied to code_snippet after comment stripping "
+             "(default: 4000)."
+    )
+    parser.add_argument(
+        "--cache-dir", default=".gpt_cache",
+        help="On-disk cache for (model, prompt) results; duplicate alerts "
+             "and reruns skip the API entirely (default: .gpt_cache)."
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=500,
+        help="OpenAI requests-per-minute budget (default: 500)."
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=200000,
+        help="OpenAI tokens-per-minute budget (default: 200000)."
     )
     parser.add_argument(
         "--db_timeout", type=int, default=30,
@@ -143,13 +644,10 @@ def main():
         print("Error: OpenAI API key not provided. Use -k or set OPENAI_API_KEY.", file=sys.stderr)
         sys.exit(1)
 
-    # Read the API key from the file specified by the -k argument
+    # -k accepts either a key file path or the raw key; resolved exactly
+    # once here rather than per request
     try:
-        with open(args.api_key, "r") as file:
-            args.api_key = file.read().strip()
-    except FileNotFoundError:
-        print(f"Error: API key file not found: {args.api_key}", file=sys.stderr)
-        sys.exit(1)
+        args.api_key = load_api_key(args.api_key)
     except Exception as e:
         print(f"Error reading API key file: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -164,73 +662,314 @@ def main():
         trusted_connection="yes",
     )
 
+    if args.driver_backend == "turbodbc" and turbodbc is None:
+        print("Error: --driver-backend turbodbc requires the turbodbc package.", file=sys.stderr)
+        sys.exit(1)
+
+    pool = None
+
     try:
-        # Connect to SQL Server
-        conn = pyodbc.connect(conn_str, timeout=args.db_timeout)
+        # Pre-open a small pyodbc pool; the streaming SELECT takes one
+        # connection, writebacks and retries borrow others
+        pool = ConnectionPool(conn_str, timeout=args.db_timeout)
+        if args.driver_backend == "turbodbc":
+            conn = turbodbc.connect(
+                connection_string=conn_str,
+                turbodbc_options=turbodbc.make_options(use_async_io=True),
+            )
+        else:
+            conn = pool.acquire_blocking()
         cursor = conn.cursor()
 
-        # Only required columns; filter out rows with '(SCA)' at the SQL level, keep NULLs
+        # Make sure the durable output table exists, then load the
+        # checkpoint: alert_ids analyzed by previous runs are skipped, so
+        # reruns after a crash only pay for the delta
+        setup_conn = pool.acquire_blocking()
+        try:
+            setup_cursor = setup_conn.cursor()
+            setup_cursor.execute(CREATE_ANALYSIS_TABLE)
+            setup_conn.commit()
+            # Give alerts added since their snippet's representative was
+            # analyzed the existing verdict before the checkpoint loads
+            setup_cursor.execute(FANOUT_EXISTING_ANALYSIS)
+            setup_conn.commit()
+            done_ids = {
+                str(r[0])
+                for r in setup_cursor.execute("SELECT alert_id FROM alert_analysis")
+            }
+            setup_cursor.close()
+        finally:
+            pool.release(setup_conn)
+        if done_ids:
+            print(f"Checkpoint: {len(done_ids)} alerts already analyzed, will skip.")
+
+        # Only required columns; the '(SCA)' filter stays in SQL (keep NULLs)
+        # and a CTE keyed on the snippet hash picks one representative row
+        # per distinct code_snippet, so duplicates never reach the model
         query = """
+            WITH u AS (
+                SELECT
+                    MIN(alert_id) AS rep_id,
+                    HASHBYTES('SHA2_256', code_snippet) AS h
+                FROM alerts
+                WHERE rule_id IS NULL OR LOWER(rule_id) NOT LIKE '%(sca)%'
+                GROUP BY HASHBYTES('SHA2_256', code_snippet)
+            )
             SELECT
-                alert_id,
-                rule_id,
-                dismissed_reason,
-                dismissed_comment,
-                code_snippet
-            FROM alerts
-            WHERE rule_id IS NULL OR LOWER(rule_id) NOT LIKE '%(sca)%'
+                a.alert_id,
+                a.rule_id,
+                a.dismissed_reason,
+                a.dismissed_comment,
+                a.code_snippet,
+                u.h AS snippet_hash
+            FROM alerts a
+            JOIN u ON a.alert_id = u.rep_id
         """
-        cursor.execute(query)
+        cursor.arraysize = 1000  # fetchmany chunk size
 
-        # Column names
-        columns = [desc[0] for desc in cursor.description]
-        print("Columns:", columns)
-
-        # Initialize OpenAI client
+        # Initialize the cached OpenAI client over its shared HTTP/2
+        # transport; keep a transport handle for shutdown
         client = get_openai_client(args.api_key)
-
-        # Fetch and process rows
-        rows = cursor.fetchall()
-        print(f"Total rows fetched (post-SQL filter): {len(rows)}")
-
-        skipped = 0
-        analyzed = 0
-
-        for row in rows:
-            record = dict(zip(columns, row))
-            rule_id_val = str(record.get("rule_id") or "")
-
-            # Defensive Python-side skip in case SQL filter misses anything
-            if "(sca)" in rule_id_val.lower():
-                skipped += 1
-                print(f"[SKIP] alert_id={record.get('alert_id')} rule_id='{rule_id_val}' contains '(SCA)'.")
-                continue
-
-            payload = {
-                "alert_id": record.get("alert_id"),
-                "rule_id": record.get("rule_id"),
-                "dismissed_reason": record.get("dismissed_reason"),
-                "dismissed_comment": record.get("dismissed_comment"),
-                "code_snippet": record.get("code_snippet"),
+        http_client = _shared_http_client()
+
+        # On-disk result cache; identical prompts are answered for free
+        cache = Cache(args.cache_dir)
+
+        counts = {"fetched": 0, "analyzed": 0, "resumed": 0}
+        pending_rows = []  # completed verdicts awaiting SQL writeback
+
+        def to_payload(row):
+            # Count, apply the checkpoint, and shape one fetched Row into
+            # an analysis payload (or None); the (SCA) filter and snippet
+            # dedup are fully handled by the SQL above
+            counts["fetched"] += 1
+            if str(row.alert_id) in done_ids:
+                counts["resumed"] += 1
+                return None
+            return {
+                "alert_id": row.alert_id,
+                "rule_id": row.rule_id,
+                "dismissed_reason": row.dismissed_reason,
+                "dismissed_comment": row.dismissed_comment,
+                # alerts carries no line number today; trim_snippet centers
+                # on it automatically if the column ever appears
+                "code_snippet": trim_snippet(
+                    row.code_snippet,
+                    max_chars=args.snippet_max_chars,
+                    line_number=getattr(row, "line_number", None),
+                ),
+                "snippet_hash": row.snippet_hash,
             }
 
-            result = analyze_with_gpt(client, args.model, payload)
-
-            analyzed += 1
+        async def row_stream():
+            # Every blocking ODBC call runs via asyncio.to_thread so the
+            # event loop keeps servicing OpenAI completions; the SELECT
+            # itself is the first of them
+            await asyncio.to_thread(cursor.execute, query)
+
+            # Bind column names once; Row._make avoids allocating a fresh
+            # dict plus string keys for every fetched row
+            columns = [desc[0] for desc in cursor.description]
+            Row = collections.namedtuple("Row", columns)
+            print("Columns:", columns)
+
+            if args.driver_backend == "turbodbc":
+                # Bulk columnar read in C; one thread hop for the whole
+                # result set instead of per-row tuple building
+                table = await asyncio.to_thread(cursor.fetchallarrow)
+                for arrow_batch in table.to_batches(max_chunksize=1000):
+                    for record in arrow_batch.to_pylist():
+                        payload = to_payload(Row(**record))
+                        if payload is not None:
+                            yield payload
+                return
+            # Stream payloads in fetchmany chunks; the blocking fetch runs
+            # in a thread so OpenAI calls keep progressing meanwhile
+            while True:
+                rows = await asyncio.to_thread(cursor.fetchmany, cursor.arraysize)
+                if not rows:
+                    return
+                for row in map(Row._make, rows):
+                    payload = to_payload(row)
+                    if payload is not None:
+                        yield payload
+
+        def report(payload, result):
+            if result is None:
+                result = {
+                    "classification": "uncertain",
+                    "reasoning": "No result returned for this alert.",
+                    "recommended_action": "Retry or check API configuration.",
+                }
+            elif isinstance(result, Exception):
+                result = {
+                    "classification": "uncertain",
+                    "reasoning": f"API error: {result}",
+                    "recommended_action": "Retry or check API configuration.",
+                }
+
+            counts["analyzed"] += 1
             classification = result.get("classification", "uncertain")
-            reasoning = result.get("reasoning", "")
-            recommended_action = result.get("recommended_action", "")
 
-            # Print the raw row and analysis summary
-            print("Row:", record)
-            print(f"Analysis -> classification: {classification}")
-            if reasoning:
-                print(f"Reasoning: {reasoning}")
-            if recommended_action:
-                print(f"Recommended action: {recommended_action}")
-            print("-" * 60)
-
-        print(f"Done. Analyzed: {analyzed}, Skipped: {skipped}")
+            # Buffer for the batched SQL writeback; stdout gets one line
+            pending_rows.append((
+                str(payload["alert_id"]),
+                classification,
+                result.get("reasoning", ""),
+                result.get("recommended_action", ""),
+                payload.get("snippet_hash"),
+            ))
+            print(f"alert_id={payload['alert_id']} -> {classification}")
+
+        def flush_blocking(wconn, batch):
+            # Rows with a snippet hash fan out to every sibling alert that
+            # shares the snippet; the NULL-snippet group (hash is NULL) fans
+            # out through its own IS NULL variant
+            fanout = [
+                (cls, reasoning, action, h)
+                for (_aid, cls, reasoning, action, h) in batch
+                if h is not None
+            ]
+            null_fanout = [
+                (cls, reasoning, action)
+                for (_aid, cls, reasoning, action, h) in batch
+                if h is None
+            ]
+            wcursor = wconn.cursor()
+            wcursor.fast_executemany = True  # pyodbc bulk-insert fast path
+            if fanout:
+                wcursor.executemany(INSERT_ANALYSIS_FANOUT, fanout)
+            if null_fanout:
+                wcursor.executemany(INSERT_ANALYSIS_NULL_FANOUT, null_fanout)
+            wconn.commit()
+            wcursor.close()
+
+        async def flush_results():
+            if not pending_rows:
+                return
+            batch = list(pending_rows)
+            async with pool.acquire() as wconn:
+                await asyncio.to_thread(flush_blocking, wconn, batch)
+            # Drop buffered rows only once they are durably committed, so a
+            # failed flush keeps them for the next attempt
+            del pending_rows[: len(batch)]
+
+        async def run():
+            if args.mode == "batch":
+                payloads = [payload async for payload in row_stream()]
+                by_id = await run_batch(client, args.strong_model, payloads)
+                for payload in payloads:
+                    report(payload, by_id.get(str(payload["alert_id"])))
+                await flush_results()
+                return
+
+            sem = asyncio.Semaphore(args.max_concurrency)
+            # Separate rate-limit budgets per model so escalations to the
+            # strong model never starve the cheap-model fan-out
+            limiters = {
+                model: (AsyncLimiter(args.rpm, 60), AsyncLimiter(args.tpm, 60))
+                for model in {args.cheap_model, args.strong_model}
+            }
+            num_workers = args.max_concurrency
+            # Bounded in/out queues give natural backpressure: the DB
+            # producer stalls when workers fall behind, and workers stall
+            # if the writer does
+            q = asyncio.Queue(maxsize=2 * num_workers)
+            out_q = asyncio.Queue(maxsize=2 * num_workers)
+            pack_size = max(args.pack_size, 1)
+
+            async def produce():
+                chunk = []
+                async for payload in row_stream():
+                    chunk.append(payload)
+                    if len(chunk) >= pack_size:
+                        await q.put(chunk)
+                        chunk = []
+                if chunk:
+                    await q.put(chunk)
+
+            async def escalate(payload, result):
+                # Route weak cheap-model verdicts through the strong model
+                if not needs_escalation(result) or args.strong_model == args.cheap_model:
+                    return result
+                return await analyze_with_gpt(
+                    client, args.strong_model, payload, sem, *limiters[args.strong_model],
+                    cache=cache,
+                )
+
+            async def worker():
+                while True:
+                    chunk = await q.get()
+                    try:
+                        if len(chunk) == 1:
+                            result = await analyze_with_gpt(
+                                client, args.cheap_model, chunk[0], sem, *limiters[args.cheap_model],
+                                cache=cache,
+                            )
+                            await out_q.put((chunk[0], await escalate(chunk[0], result)))
+                        else:
+                            by_id = await analyze_chunk_with_gpt(
+                                client, args.cheap_model, chunk, sem, *limiters[args.cheap_model],
+                                cache=cache,
+                            )
+                            for payload in chunk:
+                                result = by_id.get(str(payload["alert_id"]))
+                                await out_q.put((payload, await escalate(payload, result)))
+                    finally:
+                        q.task_done()
+
+            async def write():
+                while True:
+                    payload, result = await out_q.get()
+                    try:
+                        report(payload, result)
+                        if len(pending_rows) >= WRITEBACK_CHUNK:
+                            await flush_results()
+                    finally:
+                        out_q.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+            writer = asyncio.create_task(write())
+            pipeline = asyncio.gather(*workers, writer)
+
+            async def drain():
+                await produce()
+                await q.join()
+                await out_q.join()
+
+            drain_task = asyncio.create_task(drain())
+            try:
+                # Race the drain against the worker/writer pool: those tasks
+                # never return normally, so the pipeline finishing first
+                # means one of them crashed and the joins would hang forever
+                done, _ = await asyncio.wait(
+                    {drain_task, pipeline}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if drain_task not in done:
+                    pipeline.result()  # re-raises the crashed task's error
+                drain_task.result()
+                await flush_results()
+            finally:
+                drain_task.cancel()
+                if not pipeline.done():
+                    pipeline.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await pipeline
+
+        async def run_and_close():
+            try:
+                await run()
+            finally:
+                # Close the shared transport once the fan-out finishes
+                await http_client.aclose()
+
+        asyncio.run(run_and_close())
+
+        print(f"Done. Analyzed: {counts['analyzed']}, "
+              f"Resumed from checkpoint: {counts['resumed']} "
+              f"(of {counts['fetched']} distinct snippets fetched).")
+        print(f"Prompt tokens: {_usage_totals['prompt_tokens']} "
+              f"(served from prompt cache: {_usage_totals['cached_tokens']}).")
 
     except Exception as e:
         print("Error:", e)
@@ -243,9 +982,14 @@ def main():
             pass
         try:
             if conn is not None:
-                conn.close()
+                if pool is not None and args.driver_backend != "turbodbc":
+                    pool.release(conn)
+                else:
+                    conn.close()
         except Exception:
             pass
+        if pool is not None:
+            pool.close()
 
 
 if __name__ == "__main__":